@@ -1,9 +1,8 @@
 import fractions
 import logging
-import math
-from itertools import tee
-from struct import pack, unpack_from
-from typing import Iterator, List, Optional, Sequence, Tuple, Type, TypeVar
+from functools import lru_cache
+from struct import Struct
+from typing import Iterator, List, Optional, Tuple, Type, TypeVar
 
 import av
 from av.frame import Frame
@@ -21,19 +20,30 @@ PACKET_MAX = 1300
 NAL_TYPE_FU_A = 28
 NAL_TYPE_STAP_A = 24
 
+# NAL unit types 1-23 are carried as single NAL unit packets (RFC 6184),
+# indexed by the 5-bit NAL unit type.
+NAL_TYPES_SINGLE = tuple(t in range(1, 24) for t in range(32))
+
 NAL_HEADER_SIZE = 1
 FU_A_HEADER_SIZE = 2
 LENGTH_FIELD_SIZE = 2
 STAP_A_HEADER_SIZE = NAL_HEADER_SIZE + LENGTH_FIELD_SIZE
 
+LENGTH_FIELD = Struct("!H")
+
 DESCRIPTOR_T = TypeVar("DESCRIPTOR_T", bound="H264PayloadDescriptor")
-T = TypeVar("T")
 
 
-def pairwise(iterable: Sequence[T]) -> Iterator[Tuple[T, T]]:
-    a, b = tee(iterable)
-    next(b, None)
-    return zip(a, b)
+@lru_cache(maxsize=256)
+def _fu_headers(f_nri: int, nal: int) -> Tuple[bytes, bytes, bytes]:
+    # All slice NALs of a frame share the same F/NRI bits and NAL type,
+    # so the three FU-A headers are constant across fragments and frames.
+    fu_indicator = f_nri | NAL_TYPE_FU_A
+    return (
+        bytes([fu_indicator, nal | 0x80]),
+        bytes([fu_indicator, nal]),
+        bytes([fu_indicator, nal | 0x40]),
+    )
 
 
 class H264PayloadDescriptor:
@@ -54,7 +64,7 @@ class H264PayloadDescriptor:
         f_nri = data[0] & (0x80 | 0x60)
         pos = NAL_HEADER_SIZE
 
-        if nal_type in range(1, 24):
+        if NAL_TYPES_SINGLE[nal_type]:
             # single NAL unit
             output = bytes([0, 0, 0, 1]) + data
             obj = cls(first_fragment=True)
@@ -74,22 +84,28 @@ class H264PayloadDescriptor:
         elif nal_type == NAL_TYPE_STAP_A:
             # single time aggregation packet
             offsets = []
-            while pos < len(data):
-                if len(data) < pos + LENGTH_FIELD_SIZE:
+            unpack_length = LENGTH_FIELD.unpack_from
+            data_length = len(data)
+            while pos < data_length:
+                if data_length < pos + LENGTH_FIELD_SIZE:
                     raise ValueError("STAP-A length field is truncated")
-                nulu_size = unpack_from("!H", data, pos)[0]
+                nulu_size = unpack_length(data, pos)[0]
                 pos += LENGTH_FIELD_SIZE
                 offsets.append(pos)
 
                 pos += nulu_size
-                if len(data) < pos:
+                if data_length < pos:
                     raise ValueError("STAP-A data is truncated")
 
-            offsets.append(len(data) + LENGTH_FIELD_SIZE)
-            for start, end in pairwise(offsets):
-                end -= LENGTH_FIELD_SIZE
-                output += bytes([0, 0, 0, 1])
-                output += data[start:end]
+            offsets.append(data_length + LENGTH_FIELD_SIZE)
+            view = memoryview(data)
+            parts = []
+            for i in range(len(offsets) - 1):
+                start = offsets[i]
+                end = offsets[i + 1] - LENGTH_FIELD_SIZE
+                parts.append(bytes([0, 0, 0, 1]))
+                parts.append(view[start:end])
+            output = b"".join(parts)
 
             obj = cls(first_fragment=True)
         else:
@@ -115,48 +131,60 @@ class H264Decoder(Decoder):
         return frames
 
 
-class H264Encoder(Encoder):
-    def __init__(self) -> None:
-        self.codec: Optional[av.CodecContext] = None
+class H264PacketizerMixin:
+    """
+    Packetization of an Annex B bitstream into RTP payloads, shared by
+    :class:`H264Encoder` and :class:`H264Packer`.
+    """
 
     @staticmethod
     def _packetize_fu_a(data: bytes) -> List[bytes]:
         available_size = PACKET_MAX - FU_A_HEADER_SIZE
         payload_size = len(data) - NAL_HEADER_SIZE
-        num_packets = math.ceil(payload_size / available_size)
+        num_packets = -(-payload_size // available_size)
         num_larger_packets = payload_size % num_packets
         package_size = payload_size // num_packets
 
         f_nri = data[0] & (0x80 | 0x60)  # fni of original header
         nal = data[0] & 0x1F
 
-        fu_indicator = f_nri | NAL_TYPE_FU_A
-
-        fu_header_end = bytes([fu_indicator, nal | 0x40])
-        fu_header_middle = bytes([fu_indicator, nal])
-        fu_header_start = bytes([fu_indicator, nal | 0x80])
-        fu_header = fu_header_start
-
-        packages = []
-        offset = NAL_HEADER_SIZE
-        while offset < len(data):
-            if num_larger_packets > 0:
-                num_larger_packets -= 1
-                payload = data[offset : offset + package_size + 1]
-                offset += package_size + 1
-            else:
-                payload = data[offset : offset + package_size]
-                offset += package_size
-
-            if offset == len(data):
+        fu_header_start, fu_header_middle, fu_header_end = _fu_headers(f_nri, nal)
+
+        # The first num_larger_packets fragments carry one extra byte, so
+        # the fragment boundaries can be computed up front instead of
+        # branching on a countdown inside the loop.
+        starts = [
+            NAL_HEADER_SIZE + i * package_size + min(i, num_larger_packets)
+            for i in range(num_packets + 1)
+        ]
+        assert starts[-1] == len(data), "incorrect fragment data"
+
+        # Assemble all fragments in a single preallocated buffer, then
+        # slice the packets out of it, so the allocator is hit once per
+        # NAL unit instead of several times per fragment. Slicing the
+        # payload through a memoryview avoids an intermediate copy.
+        data_view = memoryview(data)
+        buf = bytearray(num_packets * FU_A_HEADER_SIZE + payload_size)
+        bounds = [0]
+        dst = 0
+        for i in range(num_packets):
+            offset = starts[i]
+            offset_end = starts[i + 1]
+            if i == num_packets - 1:
                 fu_header = fu_header_end
+            elif i == 0:
+                fu_header = fu_header_start
+            else:
+                fu_header = fu_header_middle
 
-            packages.append(fu_header + payload)
-
-            fu_header = fu_header_middle
-        assert offset == len(data), "incorrect fragment data"
+            buf[dst : dst + FU_A_HEADER_SIZE] = fu_header
+            dst += FU_A_HEADER_SIZE
+            buf[dst : dst + offset_end - offset] = data_view[offset:offset_end]
+            dst += offset_end - offset
+            bounds.append(dst)
 
-        return packages
+        view = memoryview(buf)
+        return [bytes(view[bounds[i] : bounds[i + 1]]) for i in range(len(bounds) - 1)]
 
     @staticmethod
     def _packetize_stap_a(
@@ -167,20 +195,29 @@ class H264Encoder(Encoder):
 
         stap_header = NAL_TYPE_STAP_A | (data[0] & 0xE0)
 
-        payload = bytes()
+        # Write length fields and NAL units into a buffer sized for the
+        # worst case, so aggregation performs no per-NAL allocations.
+        payload = bytearray(PACKET_MAX)
+        pack_length = LENGTH_FIELD.pack_into
+        pos = NAL_HEADER_SIZE
         try:
             nalu = data  # with header
-            while len(nalu) <= available_size:
+            nalu_length = len(nalu)
+            while nalu_length <= available_size:
                 stap_header |= nalu[0] & 0x80
 
                 nri = nalu[0] & 0x60
                 if stap_header & 0x60 < nri:
                     stap_header = stap_header & 0x9F | nri
 
-                available_size -= LENGTH_FIELD_SIZE + len(nalu)
+                available_size -= LENGTH_FIELD_SIZE + nalu_length
                 counter += 1
-                payload += pack("!H", len(nalu)) + nalu
+                pack_length(payload, pos, nalu_length)
+                pos += LENGTH_FIELD_SIZE
+                payload[pos : pos + nalu_length] = nalu
+                pos += nalu_length
                 nalu = next(packages_iterator)
+                nalu_length = len(nalu)
 
             if counter == 0:
                 nalu = next(packages_iterator)
@@ -188,38 +225,48 @@ class H264Encoder(Encoder):
             nalu = None
 
         if counter <= 1:
-            return data, nalu
+            # materialize the NAL unit in case it is a zero-copy view
+            return bytes(data), nalu
         else:
-            return bytes([stap_header]) + payload, nalu
+            payload[0] = stap_header
+            del payload[pos:]
+            return bytes(payload), nalu
 
     @staticmethod
     def _split_bitstream(buf: bytes) -> Iterator[bytes]:
-        # TODO: write in a more pytonic way,
-        # translate from: https://github.com/aizvorski/h264bitstream/blob/master/h264_nal.c#L134
+        # Translated from https://github.com/aizvorski/h264bitstream/blob/master/h264_nal.c#L134
+        # with the byte-by-byte scan replaced by `bytes.find`, which locates
+        # the start codes in a single C-level search instead of a Python loop.
+        #
+        # NAL units are yielded as zero-copy views over the bitstream; the
+        # packetizers only materialize bytes when emitting a packet.
+        view = memoryview(buf)
+        find = buf.find
         i = 0
         while True:
-            while (buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01) and (
-                    buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0 or buf[i + 3] != 0x01
-            ):
-                i += 1  # skip leading zero
-                if i + 4 >= len(buf):
-                    return
-            if buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01:
-                i += 1
+            # Find the start of the NAL unit.
+            #
+            # NAL units start with a 3-byte or 4-byte start code. The
+            # `bytes.find` below catches both, as a 4-byte start code
+            # contains a 3-byte one.
+            i = find(b"\x00\x00\x01", i)
+            if i == -1:
+                return
+
+            # Jump past the start code
             i += 3
             nal_start = i
-            while (buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0) and (
-                    buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01
-            ):
-                i += 1
-                # FIXME: the next line fails when reading a nal that ends
-                # exactly at the end of the data
-                if i + 3 >= len(buf):
-                    nal_end = len(buf)
-                    yield buf[nal_start:nal_end]
-                    return  # did not find nal end, stream ended first
-            nal_end = i
-            yield buf[nal_start:nal_end]
+
+            # Find the end of the NAL unit (end of buffer OR next start code)
+            i = find(b"\x00\x00\x01", i)
+            if i == -1:
+                yield view[nal_start:]
+                return
+            elif buf[i - 1] == 0:
+                # 4-byte start code case, jump back one byte
+                yield view[nal_start : i - 1]
+            else:
+                yield view[nal_start:i]
 
     @classmethod
     def _packetize(cls, packages: Iterator[bytes]) -> List[bytes]:
@@ -237,6 +284,11 @@ class H264Encoder(Encoder):
 
         return packetized_packages
 
+
+class H264Encoder(H264PacketizerMixin, Encoder):
+    def __init__(self) -> None:
+        self.codec: Optional[av.CodecContext] = None
+
     def _encode_frame(
             self, frame: av.VideoFrame, force_keyframe: bool
     ) -> Iterator[bytes]:
@@ -259,7 +311,12 @@ class H264Encoder(Encoder):
             }
 
         packages = self.codec.encode(frame)
-        yield from self._split_bitstream(b"".join(p.to_bytes() for p in packages))
+        if len(packages) == 1:
+            # common case, no need to join
+            buf = packages[0].to_bytes()
+        else:
+            buf = b"".join(p.to_bytes() for p in packages)
+        yield from self._split_bitstream(buf)
 
     def encode(
             self, frame: Frame, force_keyframe: bool = False
@@ -271,150 +328,19 @@ class H264Encoder(Encoder):
 
 
 
-class H264Packer(Encoder):
-
-    def __init__(self) -> None:
-        self.codec: Optional[av.CodecContext] = None
-
-    @staticmethod
-    def _packetize_fu_a(data: bytes) -> List[bytes]:
-        available_size = PACKET_MAX - FU_A_HEADER_SIZE
-        payload_size = len(data) - NAL_HEADER_SIZE
-        num_packets = math.ceil(payload_size / available_size)
-        num_larger_packets = payload_size % num_packets
-        package_size = payload_size // num_packets
-
-        f_nri = data[0] & (0x80 | 0x60)  # fni of original header
-        nal = data[0] & 0x1F
-
-        fu_indicator = f_nri | NAL_TYPE_FU_A
-
-        fu_header_end = bytes([fu_indicator, nal | 0x40])
-        fu_header_middle = bytes([fu_indicator, nal])
-        fu_header_start = bytes([fu_indicator, nal | 0x80])
-        fu_header = fu_header_start
-
-        packages = []
-        offset = NAL_HEADER_SIZE
-        while offset < len(data):
-            if num_larger_packets > 0:
-                num_larger_packets -= 1
-                payload = data[offset : offset + package_size + 1]
-                offset += package_size + 1
-            else:
-                payload = data[offset : offset + package_size]
-                offset += package_size
-
-            if offset == len(data):
-                fu_header = fu_header_end
-
-            packages.append(fu_header + payload)
-
-            fu_header = fu_header_middle
-        assert offset == len(data), "incorrect fragment data"
-
-        return packages
-
-    @staticmethod
-    def _packetize_stap_a(
-            data: bytes, packages_iterator: Iterator[bytes]
-    ) -> Tuple[bytes, bytes]:
-        counter = 0
-        available_size = PACKET_MAX - STAP_A_HEADER_SIZE
-
-        stap_header = NAL_TYPE_STAP_A | (data[0] & 0xE0)
-
-        payload = bytes()
-        try:
-            nalu = data  # with header
-            while len(nalu) <= available_size:
-                stap_header |= nalu[0] & 0x80
-
-                nri = nalu[0] & 0x60
-                if stap_header & 0x60 < nri:
-                    stap_header = stap_header & 0x9F | nri
-
-                available_size -= LENGTH_FIELD_SIZE + len(nalu)
-                counter += 1
-                payload += pack("!H", len(nalu)) + nalu
-                nalu = next(packages_iterator)
-
-            if counter == 0:
-                nalu = next(packages_iterator)
-        except StopIteration:
-            nalu = None
-
-        if counter <= 1:
-            return data, nalu
-        else:
-            return bytes([stap_header]) + payload, nalu
+class H264Packer(H264PacketizerMixin, Encoder):
+    """
+    Packetizer for a pre-encoded Annex B H.264 bitstream.
 
-    @staticmethod
-    def _split_bitstream(buf: bytes) -> Iterator[bytes]:
-        # TODO: write in a more pytonic way,
-        # translate from: https://github.com/aizvorski/h264bitstream/blob/master/h264_nal.c#L134
-        i = 0
-        while True:
-            #print(str(len(buf)))
-            #print(i)
-            if(len(buf)>=1+3):
-                while (buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01) and (
-                        buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0 or buf[i + 3] != 0x01
-                ):
-                    i += 1  # skip leading zero
-                    if i + 4 >= len(buf):
-                        return
-                if buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01:
-                    i += 1
-                i += 3
-                nal_start = i
-                while (buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0) and (
-                        buf[i] != 0 or buf[i + 1] != 0 or buf[i + 2] != 0x01
-                ):
-                    i += 1
-                    # FIXME: the next line fails when reading a nal that ends
-                    # exactly at the end of the data
-                    if i + 3 >= len(buf):
-                        nal_end = len(buf)
-                        yield buf[nal_start:nal_end]
-                        return  # did not find nal end, stream ended first
-                nal_end = i
-                yield buf[nal_start:nal_end]
-
-    @classmethod
-    def _packetize(cls, packages: Iterator[bytes]) -> List[bytes]:
-        packetized_packages = []
-
-        packages_iterator = iter(packages)
-        package = next(packages_iterator, None)
-        while package is not None:
-            if len(package) > PACKET_MAX:
-                packetized_packages.extend(cls._packetize_fu_a(package))
-                package = next(packages_iterator, None)
-            else:
-                packetized, package = cls._packetize_stap_a(package, packages_iterator)
-                packetized_packages.append(packetized)
-
-        return packetized_packages
-
-    def _encode_frame(
-            self, frame:bytes, force_keyframe: bool
-    ) -> Iterator[bytes]:
-        if self.codec and (
-                frame.width != self.codec.width or frame.height != self.codec.height
-        ):
-            self.codec = None
-
-
-
-        yield from self._split_bitstream(frame)
+    Unlike :class:`H264Encoder` it holds no codec state: `encode` takes the
+    raw bitstream bytes and only splits and packetizes them.
+    """
 
     def encode(
-            self, frame:bytes, force_keyframe: bool = False
+            self, frame: bytes, force_keyframe: bool = False
     ) -> Tuple[List[bytes], int]:
-        packages = self._encode_frame(frame, force_keyframe)
-        timestamp = convert_timebase(0,fractions.Fraction(1, 90000) , VIDEO_TIME_BASE)
-        return self._packetize(packages), timestamp
+        timestamp = convert_timebase(0, fractions.Fraction(1, 90000), VIDEO_TIME_BASE)
+        return self._packetize(self._split_bitstream(frame)), timestamp
 
 
 def h264_depayload(payload: bytes) -> bytes:
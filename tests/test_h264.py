@@ -128,6 +128,12 @@ class H264Test(CodecTestCase):
         )
         self.assertEqual(len(packages), 1)
 
+        # a NAL unit ending exactly at the end of the data
+        packages = list(
+            H264Encoder._split_bitstream(b"\00\00\01\ff\ff\00\00\00\01\ff\ff")
+        )
+        self.assertEqual(packages, [b"\ff\ff", b"\ff\ff"])
+
     def test_packetize_one_small(self):
         packages = [bytes([0xFF, 0xFF])]
         packetize_packages = H264Encoder._packetize(packages)